@@ -1,163 +1,308 @@
 import streamlit as st
-import base64
+import hashlib
+import json
 import os
+import re
+from io import BytesIO
 from pptx import Presentation
+from pptx.dml.color import RGBColor
 from pptx.util import Pt
-from transformers import pipeline
 
 # Format settings
 TITLE_FONT_SIZE = Pt(30)
 SLIDE_FONT_SIZE = Pt(16)
 
+# Number of content slides per presentation
+NUM_SLIDES = 5
+
+# Shared system message for OpenAI requests; only the user message varies
+SYSTEM_PROMPT = (
+    "You are a professional PowerPoint presentation assistant. "
+    "Given a presentation topic, plan a clear, logically ordered deck for a business audience. "
+    f"Return JSON of the form {{\"slides\": [{{\"title\": ..., \"body\": ...}}]}} with {NUM_SLIDES} slide objects. "
+    "Each title is concise (at most eight words), specific to the topic and free of numbering or bullet characters. "
+    "Each body is a professional 4-5 sentence paragraph that expands on its title without repeating other slides. "
+    "Use plain text only: no markdown, no bullet points and no line breaks inside a body."
+)
+
+# One title per line, without a leading list marker ("-", "•", "*", "1.", "1)")
+# or surrounding whitespace; lines holding only a marker are skipped
+_TITLE_RE = re.compile(r"^[ \t]*(?:(?:[-•*]|\d+[.)]|\d+(?=[ \t]|$))[ \t]*)?(?!(?:[-•*]|\d+[.)]?)[ \t]*$)(\S[^\n]*?)[ \t]*$", re.M)
+
+# Characters not allowed in generated file names
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^\w \-]+")
+
+class EmptyGenerationError(Exception):
+    """Raised from cached generators so an empty result is never memoized"""
+
+def _model_kwargs():
+    # bitsandbytes int8 kernels need a CUDA device; otherwise pick a half-precision
+    # dtype only where the hardware runs it natively, since emulated bf16 is slower than fp32
+    import torch
+    if torch.cuda.is_available():
+        try:
+            import bitsandbytes  # noqa: F401
+            from transformers import BitsAndBytesConfig
+        except ImportError:
+            return {"torch_dtype": torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16}
+        return {"quantization_config": BitsAndBytesConfig(load_in_8bit=True), "device_map": "auto"}
+    try:
+        cpu_bf16 = torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        cpu_bf16 = False
+    return {"torch_dtype": torch.bfloat16} if cpu_bf16 else {}
+
+@st.cache_resource
+def get_tokenizer():
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    # GPT-2 has no pad token; batched decoder-only generation needs left padding
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+@st.cache_resource
+def get_model():
+    import torch
+    from transformers import AutoModelForCausalLM
+    model = AutoModelForCausalLM.from_pretrained("gpt2", **_model_kwargs())
+    # The 8-bit model is placed by device_map; otherwise move it to the GPU here
+    if torch.cuda.is_available() and not getattr(model, "hf_device_map", None):
+        model.to("cuda")
+    return model
+
 def get_generator():
-    # Use Streamlit resource cache for efficiency
-    @st.cache_resource
-    def load_generator():
-        return pipeline("text-generation", model="gpt2")
-    return load_generator()
+    # Tokenizer and model are cached separately so either can be swapped alone.
+    # transformers is imported here so it only loads when the fallback is used.
+    from transformers import pipeline
+    model = get_model()
+    # Run inputs on the model's device unless accelerate already dispatched it
+    device = None if getattr(model, "hf_device_map", None) else model.device
+    return pipeline("text-generation", model=model, tokenizer=get_tokenizer(), batch_size=8, device=device)
 
-generator = get_generator()
+# Bounded so every distinct key entered in the public app doesn't keep an open pool forever
+@st.cache_resource(max_entries=16, ttl=3600)
+def get_openai_client(api_key):
+    """
+    Shared OpenAI client per API key, so the connection pool survives reruns
+    """
+    import httpx
+    import openai
+    # The SDK retries rate limits, 5xx and connection errors (including pool
+    # timeouts) with exponential backoff, so transient failures stay on this path
+    return openai.OpenAI(
+        api_key=api_key,
+        max_retries=3,
+        http_client=httpx.Client(
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+            timeout=httpx.Timeout(30.0, connect=2.0)
+        )
+    )
+
+def _parse_titles(text):
+    return [m.group(1) for m in _TITLE_RE.finditer(text)][:NUM_SLIDES]
+
+def _newline_stopping_criteria(prompt_length, max_lines):
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class NewlineStop(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            generated = input_ids[:, prompt_length:]
+            # GPT-2 token ids: 198 is "\n", 628 is "\n\n"
+            is_newline = (generated == 198) | (generated == 628)
+            # A line is finished by the first newline after some text, so blank
+            # lines between list items and empty lines don't count
+            line_ends = is_newline.clone()
+            line_ends[:, 0] = False
+            line_ends[:, 1:] &= ~is_newline[:, :-1]
+            return line_ends.sum(dim=1) >= max_lines
+    return StoppingCriteriaList([NewlineStop()])
 
-def generate_slide_titles(topic: str, openai_api_key: str = None) -> list:
+@st.cache_data(show_spinner=False)
+def generate_fallback_titles(topic):
     """
-    Generate informative PowerPoint slide titles for a given topic using OpenAI API or fallback
+    Generate slide titles with the local HuggingFace model
     """
-    def fallback_titles():
-        prompt = f"Generate 5 professional PowerPoint slide titles about: {topic}\n1."
+    prompt = f"Generate 5 professional PowerPoint slide titles about: {topic}\n1."
+    import torch
+    generator = get_generator()
+    prompt_length = len(get_tokenizer()(prompt)["input_ids"])
+    with torch.inference_mode():
+        # Only the generated lines are needed; stop once every title line is finished
         result = generator(
             prompt,
             max_new_tokens=80,
             num_return_sequences=1,
             truncation=True,
-            pad_token_id=50256
+            pad_token_id=50256,
+            return_full_text=False,
+            stopping_criteria=_newline_stopping_criteria(prompt_length, NUM_SLIDES)
         )[0]['generated_text']
-        lines = result.split("\n")
-        titles = [line.strip("-•1234567890. ") for line in lines if line.strip()]
-        return [t for t in titles if t][:5]
-    if openai_api_key:
-        try:
-            import openai
-            client = openai.OpenAI(api_key=openai_api_key)
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a professional PowerPoint presentation assistant. Generate 5 concise slide titles."},
-                    {"role": "user", "content": f"Generate 5 professional PowerPoint slide titles about: {topic}"}
-                ],
-                temperature=0.7,
-                max_tokens=200
-            )
-            content = response.choices[0].message.content
-            titles = [line.strip("-•1234567890. ") for line in content.split("\n") if line.strip()]
-            titles = [t for t in titles if t][:5]
-            if not titles:
-                st.warning("OpenAI did not return any titles, using fallback.")
-                return fallback_titles()
-            return titles
-        except Exception as e:
-            st.warning(f"OpenAI error: {e}. Using fallback model.")
-            return fallback_titles()
-    else:
-        return fallback_titles()
-
-def generate_slide_content(title, openai_api_key=None):
+    titles = _parse_titles(result)
+    if not titles:
+        raise EmptyGenerationError("The fallback model did not return any titles")
+    return titles
+
+@st.cache_data(show_spinner=False)
+def _cached_fallback_contents(titles):
+    prompts = [f"Generate a professional PowerPoint paragraph about {title} (4-5 sentences):" for title in titles]
+    import torch
+    generator = get_generator()
+    # A single call with a list of prompts lets the pipeline batch them
+    with torch.inference_mode():
+        results = generator(
+            prompts,
+            max_new_tokens=120,
+            num_return_sequences=1,
+            truncation=True,
+            pad_token_id=50256
+        )
+    return [result[0]['generated_text'].split(":")[-1].strip() for result in results]
+
+def generate_fallback_contents(titles):
+    """
+    Generate content for all slides with the local HuggingFace model
+    """
+    try:
+        return _cached_fallback_contents(tuple(titles))
+    except Exception as e:
+        st.error(f"Error generating slide content: {e}")
+        return ["(Content generation failed)"] * len(titles)
+
+def generate_fallback_slides(topic):
+    """
+    Generate slide titles and content with the local HuggingFace model
+    """
+    try:
+        titles = generate_fallback_titles(topic)
+    except EmptyGenerationError:
+        return [], []
+    return titles, generate_fallback_contents(titles)
+
+@st.cache_data(show_spinner=False)
+def _cached_openai_slides(topic, key_fingerprint, _api_key):
+    # The key itself is excluded from the cache key (leading underscore);
+    # key_fingerprint keeps results from different keys apart.
+    client = get_openai_client(_api_key)
+    response = client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Create a PowerPoint presentation about: {topic}"}
+        ],
+        response_format={"type": "json_object"},
+        temperature=0.7,
+        max_tokens=1500
+    )
+    slides = []
+    for slide in json.loads(response.choices[0].message.content)["slides"]:
+        # SYSTEM_PROMPT already asks for titles without numbering
+        title = slide.get("title", "").strip()
+        if title:
+            slides.append({"title": title, "body": slide.get("body", "").strip()})
+    if not slides:
+        raise EmptyGenerationError("OpenAI did not return any slides")
+    return slides[:NUM_SLIDES]
+
+def generate_slides(topic: str, openai_api_key: str = None) -> tuple:
     """
-    Generate PowerPoint slide content using OpenAI or HuggingFace
+    Generate slide titles and content for a topic in a single OpenAI request, or with the fallback model
     """
+    if not openai_api_key:
+        return generate_fallback_slides(topic)
     try:
-        if openai_api_key:
-            import openai
-            client = openai.OpenAI(api_key=openai_api_key)
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a PowerPoint slide content generator."},
-                    {"role": "user", "content": f"Write a professional 4-5 sentence paragraph for PowerPoint about: {title}"}
-                ],
-                temperature=0.7,
-                max_tokens=200
-            )
-            return response.choices[0].message.content.strip()
-        else:
-            prompt = f"Generate a professional PowerPoint paragraph about {title} (4-5 sentences):"
-            result = generator(
-                prompt,
-                max_new_tokens=120,
-                num_return_sequences=1,
-                truncation=True,
-                pad_token_id=50256
-            )[0]['generated_text']
-            content = result.split(":")[-1].strip()
-            return content
+        key_fingerprint = hashlib.sha256(openai_api_key.encode()).hexdigest()[:8]
+        slides = _cached_openai_slides(topic, key_fingerprint, openai_api_key)
+    except EmptyGenerationError:
+        st.warning("OpenAI did not return any slides, using fallback.")
+        return generate_fallback_slides(topic)
     except Exception as e:
-        st.error(f"Error generating content for '{title}': {e}")
-        return "(Content generation failed)"
+        st.warning(f"OpenAI error: {e}. Using fallback model.")
+        return generate_fallback_slides(topic)
+    titles = [s["title"] for s in slides]
+    contents = [s["body"] for s in slides]
+    return titles, contents
+
+def ppt_filename(topic):
+    safe_topic = _UNSAFE_FILENAME_CHARS.sub("", topic)
+    return f"{safe_topic}_presentation.pptx"
+
+@st.cache_resource
+def _template_bytes():
+    # python-pptx's bundled default template, read once instead of on every Presentation()
+    import pptx
+    with open(os.path.join(os.path.dirname(pptx.__file__), "templates", "default.pptx"), "rb") as f:
+        return f.read()
+
+def _hex_rgb(h):
+    return RGBColor(int(h[1:3], 16), int(h[3:5], 16), int(h[5:7], 16))
 
-def create_ppt(topic, titles, contents, bg_color="#FFFFFF", title_color="#000000", content_color="#000000", title_size=30, content_size=16, border_color=None, border_width=0):
-    from pptx.dml.color import RGBColor
-    prs = Presentation()
+def create_ppt(topic, titles, contents, bg_color="#FFFFFF", title_color="#000000", content_color="#000000", title_size=30, content_size=16, border_color=None, border_width=0, save_dir=None):
+    """
+    Build the presentation in memory and return it as a BytesIO; pass save_dir to also write it to disk
+    """
+    # Colors are the same on every slide, so parse them once
+    bg_rgb, title_rgb, content_rgb, border_rgb = map(_hex_rgb, (bg_color, title_color, content_color, border_color or "#000000"))
+    title_pt, content_pt = Pt(title_size), Pt(content_size)
+    prs = Presentation(BytesIO(_template_bytes()))
+    # Set the background once on the slide master; every slide inherits it
+    fill = prs.slide_master.background.fill
+    fill.solid()
+    fill.fore_color.rgb = bg_rgb
     # Title Slide
     title_slide_layout = prs.slide_layouts[0]  # Title Slide
     title_slide = prs.slides.add_slide(title_slide_layout)
     title_slide.shapes.title.text = topic
-    # Set title slide background color
-    fill = title_slide.background.fill
-    fill.solid()
-    fill.fore_color.rgb = RGBColor(int(bg_color[1:3], 16), int(bg_color[3:5], 16), int(bg_color[5:7], 16))
-    # Set title color and size
-    for p in title_slide.shapes.title.text_frame.paragraphs:
-        for run in p.runs:
-            run.font.size = Pt(title_size)
-            run.font.color.rgb = RGBColor(int(title_color[1:3], 16), int(title_color[3:5], 16), int(title_color[5:7], 16))
+    # Set title color and size on the paragraph defaults; runs inherit them
+    title_font = title_slide.shapes.title.text_frame.paragraphs[0].font
+    title_font.size = title_pt
+    title_font.color.rgb = title_rgb
+    # Read the default image once; python-pptx stores identical images as a single part
+    image_path = os.path.join(os.path.dirname(__file__), "default.jpg")
+    image_bytes = None
+    if os.path.exists(image_path):
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+    # Insert image at a fixed position and size (customize as needed)
+    image_left = Pt(400)
+    image_top = Pt(100)
+    image_width = Pt(200)
     # Content Slides
     content_slide_layout = prs.slide_layouts[1]  # Title and Content
     for title, content in zip(titles, contents):
         slide = prs.slides.add_slide(content_slide_layout)
-        # Set background color
-        fill = slide.background.fill
-        fill.solid()
-        fill.fore_color.rgb = RGBColor(int(bg_color[1:3], 16), int(bg_color[3:5], 16), int(bg_color[5:7], 16))
         slide.shapes.title.text = title
         # Set title color and size
-        for p in slide.shapes.title.text_frame.paragraphs:
-            for run in p.runs:
-                run.font.size = Pt(title_size)
-                run.font.color.rgb = RGBColor(int(title_color[1:3], 16), int(title_color[3:5], 16), int(title_color[5:7], 16))
-        # Add content to the body placeholder
-        for shape in slide.placeholders:
-            if shape.placeholder_format.idx == 1:  # Body placeholder
-                shape.text = content
-                # Set font size and color for all paragraphs
-                for p in shape.text_frame.paragraphs:
-                    for run in p.runs:
-                        run.font.size = Pt(content_size)
-                        run.font.color.rgb = RGBColor(int(content_color[1:3], 16), int(content_color[3:5], 16), int(content_color[5:7], 16))
-                # Add border if requested
-                if border_color and border_width > 0:
-                    sp = shape
-                    ln = sp.line
-                    ln.color.rgb = RGBColor(int(border_color[1:3], 16), int(border_color[3:5], 16), int(border_color[5:7], 16))
-                    ln.width = Pt(border_width)
-        # Add default image quickly (local file)
-        image_path = os.path.join(os.path.dirname(__file__), "default.jpg")
-        if os.path.exists(image_path):
-            # Insert image at a fixed position and size (customize as needed)
-            left = Pt(400)
-            top = Pt(100)
-            width = Pt(200)
-            slide.shapes.add_picture(image_path, left, top, width=width)
-    os.makedirs("generated_ppt", exist_ok=True)
-    safe_topic = "".join(c for c in topic if c.isalnum() or c in (" ", "_", "-"))
-    path = f"generated_ppt/{safe_topic}_presentation.pptx"
-    prs.save(path)
-    return path
-
-def get_download_link(path):
-    with open(path, "rb") as f:
-        data = f.read()
-    b64 = base64.b64encode(data).decode()
-    filename = os.path.basename(path)
-    return f'<a href="data:application/vnd.openxmlformats-officedocument.presentationml.presentation;base64,{b64}" download="{filename}">📥 Download the PowerPoint</a>'
+        title_font = slide.shapes.title.text_frame.paragraphs[0].font
+        title_font.size = title_pt
+        title_font.color.rgb = title_rgb
+        # Add content to the body placeholder (idx 1 in "Title and Content")
+        try:
+            body = slide.placeholders[1]
+        except KeyError:
+            body = None
+        if body is not None:
+            body.text = content
+            # Set font size and color for all paragraphs; styling the slide
+            # master's placeholders would avoid per-slide formatting entirely
+            for p in body.text_frame.paragraphs:
+                p.font.size = content_pt
+                p.font.color.rgb = content_rgb
+            # Add border if requested
+            if border_color and border_width > 0:
+                ln = body.line
+                ln.color.rgb = border_rgb
+                ln.width = Pt(border_width)
+        # Add default image quickly (cached bytes)
+        if image_bytes is not None:
+            slide.shapes.add_picture(BytesIO(image_bytes), image_left, image_top, width=image_width)
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+        prs.save(os.path.join(save_dir, ppt_filename(topic)))
+    buf = BytesIO()
+    prs.save(buf)
+    buf.seek(0)
+    return buf
 
 def main():
     st.title("Free Text-to-PPT Generator (CHATGPT)")
@@ -174,18 +319,27 @@ def main():
     border_color = st.color_picker("Border Color (optional)", "#000000")
     border_width = st.slider("Border Thickness (pt, 0 for none)", 0, 10, 0)
     if st.button("Generate Presentation"):
+        st.session_state.pop("presentation", None)
         if not topic:
             st.warning("Please enter a topic.")
             return
         st.info("Generating slides with AI...")
-        titles = generate_slide_titles(topic, openai_api_key)
+        titles, contents = generate_slides(topic, openai_api_key)
         if not titles or len(titles) < 1:
             st.error("Failed to generate slide titles. Please try again or check your API key.")
             return
-        contents = [generate_slide_content(title, openai_api_key) for title in titles]
-        path = create_ppt(topic, titles, contents, bg_color, title_color, content_color, title_size, content_size, border_color, border_width)
+        buf = create_ppt(topic, titles, contents, bg_color, title_color, content_color, title_size, content_size, border_color, border_width)
+        st.session_state["presentation"] = (ppt_filename(topic), buf.getvalue())
+    # Rendered outside the button branch so it survives the rerun a download triggers
+    if "presentation" in st.session_state:
+        file_name, data = st.session_state["presentation"]
         st.success("✅ Presentation created!")
-        st.markdown(get_download_link(path), unsafe_allow_html=True)
+        st.download_button(
+            "📥 Download the PowerPoint",
+            data,
+            file_name=file_name,
+            mime="application/vnd.openxmlformats-officedocument.presentationml.presentation"
+        )
 
 if __name__ == "__main__":
     main()